@@ -1,11 +1,23 @@
 import streamlit as st
-import csv
+import bisect
 import io
-from fpdf import FPDF
+import threading
+from dataclasses import dataclass
+from functools import partial
+import numpy as np
+import numba
+from numba import njit, prange
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
 
 # --- Constants ---
 MILK_DENSITY_KG_L = 1.0285
 
+# Prefer OpenMP for the parallel table kernel; the TBB pool can hang interpreter shutdown
+numba.config.THREADING_LAYER_PRIORITY = ['omp', 'tbb', 'workqueue']
+
 def convert_kg_to_litres(kg_value):
     """
     Converts Mass (KG) to Volume (L) using standard milk density.
@@ -19,11 +31,49 @@ def convert_kg_to_litres(kg_value):
     except (TypeError, ValueError):
         return 0.0
 
+def _litres_vec(kgs):
+    """Vectorized convert_kg_to_litres for a float array of KG values."""
+    return np.round(np.where(kgs < 0, 0.0, kgs / MILK_DENSITY_KG_L), 2)
+
+def sort_records_soa(soa):
+    """
+    Stores the table inputs on the SoA mirror, sorted once per records change:
+    unique DIPs ascending with their KG and litre values (last record wins for a repeated DIP).
+    Records with a blank DIP or KG are left out of the table inputs.
+    """
+    complete = ~(np.isnan(soa['dip']) | np.isnan(soa['kg']))
+    # np.unique keeps the first occurrence, so search the reversed columns
+    reversed_dips = soa['dip'][complete][::-1]
+    sorted_dips, first_idx = np.unique(reversed_dips, return_index=True)
+    order = len(reversed_dips) - 1 - first_idx
+    soa['sorted_dip'] = sorted_dips
+    soa['sorted_kg'] = soa['kg'][complete][order]
+    soa['sorted_litre'] = _litres_vec(soa['sorted_kg'])
+
+def _cell_value(value):
+    """Maps a blank editor cell (None) to NaN so it can't pass for a real 0.0 reading."""
+    return np.nan if value is None else value
+
+def records_to_soa(records):
+    """
+    Builds the column (structure-of-arrays) mirror of the records list:
+    parallel 'dip', 'kg' and 'dip_mm' float arrays in record order (NaN for blank cells),
+    plus the sorted table inputs.
+    """
+    count = len(records)
+    dips = np.fromiter((_cell_value(rec.get('DIP')) for rec in records), dtype=np.float64, count=count)
+    kgs = np.fromiter((_cell_value(rec.get('Milk (KG)')) for rec in records), dtype=np.float64, count=count)
+    soa = {'dip': dips, 'kg': kgs, 'dip_mm': np.round(dips * 10, 1)}
+    sort_records_soa(soa)
+    return soa
+
 st.title("Milk DIP Converter & Table Generator")
 
-# Initialize session state for records
+# Initialize session state for records and their column mirror
 if 'records' not in st.session_state:
     st.session_state['records'] = []
+if '_records_soa' not in st.session_state:
+    st.session_state['_records_soa'] = records_to_soa(st.session_state['records'])
 
 # --- Manual entry form ---
 with st.form("add_record_form"):
@@ -49,6 +99,11 @@ with st.form("add_record_form"):
             'DIP': round(dip, 2),
             'DIP(MM)': dip_mm
         })
+        soa = st.session_state['_records_soa']
+        soa['dip'] = np.append(soa['dip'], round(dip, 2))
+        soa['kg'] = np.append(soa['kg'], round(milk_kg, 2))
+        soa['dip_mm'] = np.append(soa['dip_mm'], dip_mm)
+        sort_records_soa(soa)
         st.success(f"Added: Milk (KG)={milk_kg}, DIP={dip}, DIP(MM)={dip_mm}")
 
 if st.session_state['records']:
@@ -56,10 +111,23 @@ if st.session_state['records']:
     
     # Callback function to auto-update DIP(MM) when DIP changes
     def update_dip_mm():
-        """Automatically update DIP(MM) based on DIP column values"""
-        for i, record in enumerate(st.session_state['records']):
-            dip_value = record.get('DIP', 0)
-            st.session_state['records'][i]['DIP(MM)'] = round(dip_value * 10, 1)
+        """Flags the editor output for a DIP(MM) update, only if a DIP or KG value changed"""
+        # Never touch st.session_state['records'] here: it is the editor's input, and
+        # changing it gives the editor a new identity that drops the pending edits.
+        soa = st.session_state['_records_soa']
+        changes = st.session_state['records_editor']
+        changed = bool(changes['added_rows'] or changes['deleted_rows'])
+        for idx, edited in changes['edited_rows'].items():
+            idx = int(idx)
+            if idx >= len(soa['dip']):
+                changed = True
+                continue
+            if 'DIP' in edited:
+                changed |= not np.array_equal(soa['dip'][idx], _cell_value(edited['DIP']), equal_nan=True)
+            if 'Milk (KG)' in edited:
+                changed |= not np.array_equal(soa['kg'][idx], _cell_value(edited['Milk (KG)']), equal_nan=True)
+        if changed:
+            st.session_state['_records_soa_stale'] = True
     
     # Use data_editor to allow editing and deletion of records
     st.session_state['records'] = st.data_editor(
@@ -69,6 +137,28 @@ if st.session_state['records']:
         key="records_editor",
         on_change=update_dip_mm
     )
+    if st.session_state.pop('_records_soa_stale', False):
+        records = st.session_state['records']
+        changes = st.session_state['records_editor']
+        soa = records_to_soa(records)
+        # Edited row indices refer to the editor input; skip past deleted rows
+        deleted = sorted(int(idx) for idx in changes['deleted_rows'])
+        rows = []
+        for idx, edited in changes['edited_rows'].items():
+            idx = int(idx)
+            if 'DIP' in edited and idx not in deleted:
+                rows.append(idx - bisect.bisect_left(deleted, idx))
+        # Rows added in the editor only exist in its output, at the end
+        rows.extend(range(len(records) - len(changes['added_rows']), len(records)))
+        # DIP(MM) comes from the mirror so both agree on the rounding; a blank
+        # DIP gets a blank DIP(MM) rather than a made-up 0.0
+        dip_mm = soa['dip_mm']
+        for row in rows:
+            records[row]['DIP(MM)'] = None if np.isnan(dip_mm[row]) else float(dip_mm[row])
+        st.session_state['_records_soa'] = soa
+        # Re-render the editor from the updated records so its identity matches
+        # the data the next edit will be applied to
+        st.rerun()
 else:
     st.info("No records added yet.")
 
@@ -76,217 +166,222 @@ else:
 
 # --- Helper Functions for Smart Interpolation ---
 
-def find_consistent_step(dip1, dip2, milk1, milk2):
-    """Calculates milk vol change per 0.1 DIP step."""
-    milk_diff = milk2 - milk1
-    dip_diff = dip2 - dip1
-    if dip_diff == 0: return 0
-    return milk_diff / (dip_diff * 10)
+@dataclass(frozen=True)
+class DipCurve:
+    """Sorted reference DIPs/volumes plus the precomputed smart slope context."""
+    sorted_dips: np.ndarray
+    vals: np.ndarray
+    slope_ctx: tuple
+
+def build_dip_curve(sorted_dips, vals):
+    """Builds the lookup arrays and slope context for pre-sorted unique DIPs, once per table."""
+    # Contiguous float64 buffers: the table kernel is compiled for unit-stride arrays
+    sorted_dips_arr = np.ascontiguousarray(sorted_dips, dtype=np.float64)
+    vals_arr = np.ascontiguousarray(vals, dtype=np.float64)
+    return DipCurve(sorted_dips_arr, vals_arr, precompute_slope_context(sorted_dips_arr, vals_arr))
 
-def calculate_smart_slope(target_dip, sorted_dips, value_map):
+def precompute_slope_context(sorted_dips, vals):
     """
-    Calculates a 'smart' slope (per 1.0 DIP) based on the average of all slopes,
-    clamping local variations to prevent wild extrapolation outliers.
+    Precomputes the target-independent part of the smart slope:
+    all interval slopes (per 0.1 DIP) and their average.
     """
     if len(sorted_dips) < 2:
-        return 25.0 # Default 2.5 per 0.1 -> 25.0 per 1.0
-    
-    slopes = []
-    # Calculate all interval slopes (per 0.1 DIP)
-    for i in range(len(sorted_dips) - 1):
-        d1, d2 = sorted_dips[i], sorted_dips[i+1]
-        v1, v2 = value_map[d1], value_map[d2]
-        if d2 > d1:
-            slopes.append(find_consistent_step(d1, d2, v1, v2))
-    
-    if not slopes:
-        return 25.0
-        
-    avg_slope = sum(slopes) / len(slopes)
-    
-    # Determine local slope based on proximity
-    if target_dip < sorted_dips[0]:
-        local_slope = slopes[0]
-    elif target_dip > sorted_dips[-1]:
-        local_slope = slopes[-1]
-    else:
-        # Find closest interval
-        closest_idx = 0
-        min_dist = float('inf')
-        for i in range(len(sorted_dips) - 1):
-            midpoint = (sorted_dips[i] + sorted_dips[i+1]) / 2
-            dist = abs(target_dip - midpoint)
-            if dist < min_dist:
-                min_dist = dist
-                closest_idx = i
-        local_slope = slopes[closest_idx]
-        
-    # Clamp the slope to be within 50% - 150% of the average slope
-    lower_limit = avg_slope * 0.5
-    upper_limit = avg_slope * 1.5
-    
-    if avg_slope >= 0:
-        clamped_slope = max(lower_limit, min(upper_limit, local_slope))
+        return np.empty(0), 0.0
+    slopes = np.diff(vals) / (np.diff(sorted_dips) * 10)
+    return slopes, float(slopes.mean())
+
+@st.cache_resource
+def _kernel_lock():
+    # One lock per process: Streamlit runs sessions on separate threads, and
+    # Numba's fallback workqueue threading layer can't launch parallel kernels concurrently
+    return threading.Lock()
+
+@njit('float64[:, ::1](float64[::1], float64[::1], int64, int64, float64[::1], float64)', cache=True, fastmath={'nnan', 'ninf', 'nsz'}, parallel=True)
+def _fill_table(sorted_dips, vals, start_int, end_int, slopes, avg_slope):
+    """Fills the (rows, 10) volume table for integer DIPs start_int..end_int."""
+    n = sorted_dips.shape[0]
+    rows = max(end_int - start_int + 1, 0)
+    out = np.empty((rows, 10), dtype=np.float64)
+
+    # Smart slopes (per 1.0 DIP); extrapolation only ever uses the edge intervals
+    if slopes.shape[0] == 0:
+        low_slope = 25.0
+        high_slope = 25.0
     else:
-        clamped_slope = max(upper_limit, min(lower_limit, local_slope))
-        
-    # Return slope per 1.0 DIP (consistent with existing logic)
-    return clamped_slope * 10
-
-def get_volume_at_dip(target_dip, sorted_dips, value_map):
-    """Calculates volume for any DIP using continuous linear interpolation."""
-    # 1. Exact Match
-    if target_dip in value_map:
-        return value_map[target_dip]
-    
-    # 2. Find surrounding points
-    lower = [d for d in sorted_dips if d < target_dip]
-    higher = [d for d in sorted_dips if d > target_dip]
-    
-    if lower and higher:
-        d1, d2 = max(lower), min(higher)
-        # Use simple linear interpolation between known points (Standard)
-        v1, v2 = value_map[d1], value_map[d2]
-        slope = (v2 - v1) / (d2 - d1)
-        return v1 + (target_dip - d1) * slope
-    
-    elif lower: # Extrapolate high (beyond last record)
-        d1 = max(lower)
-        # Use Smart Slope for safer extrapolation
-        slope = calculate_smart_slope(target_dip, sorted_dips, value_map)
-        return value_map[d1] + (target_dip - d1) * slope
-        
-    elif higher: # Extrapolate low (before first record)
-        d2 = min(higher)
-        # Use Smart Slope for safer extrapolation
-        slope = calculate_smart_slope(target_dip, sorted_dips, value_map)
-        return value_map[d2] - (d2 - target_dip) * slope
-    
-    return 0.0
+        lower_limit, upper_limit = avg_slope * 0.5, avg_slope * 1.5
+        if avg_slope < 0:
+            lower_limit, upper_limit = upper_limit, lower_limit
+        low_slope = min(max(slopes[0], lower_limit), upper_limit) * 10
+        high_slope = min(max(slopes[-1], lower_limit), upper_limit) * 10
+
+    for r in prange(rows):
+        for tenths in range(10):
+            target = (start_int + r) + tenths / 10.0
+            # Binary search for the first known DIP >= target
+            lo = 0
+            hi = n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if sorted_dips[mid] < target:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            j = lo
+
+            if j < n and sorted_dips[j] == target:
+                out[r, tenths] = vals[j]
+            elif j == 0: # Extrapolate low (before first record)
+                out[r, tenths] = vals[0] - (sorted_dips[0] - target) * low_slope
+            elif j == n: # Extrapolate high (beyond last record)
+                out[r, tenths] = vals[n - 1] + (target - sorted_dips[n - 1]) * high_slope
+            else:
+                d1, d2 = sorted_dips[j - 1], sorted_dips[j]
+                v1, v2 = vals[j - 1], vals[j]
+                out[r, tenths] = v1 + (target - d1) * ((v2 - v1) / (d2 - d1))
+    return out
 
-def generate_dip_table_from_records(records, dip_start=None, dip_end=None, mode='kg'):
+def table_inputs(soa, mode='kg'):
+    """Returns the sorted reference DIPs and the matching KG or litre values from the SoA mirror."""
+    # Pick the correct values for the selected mode (litres use the strict conversion)
+    return soa['sorted_dip'], (soa['sorted_kg'] if mode == 'kg' else soa['sorted_litre'])
+
+def generate_dip_table_from_records(soa, dip_start=None, dip_end=None, mode='kg'):
     """
     Generates a table of volumes for DIP values ranging from 0 to 9 tenths for each integer DIP.
+    soa is the records SoA mirror; its sorted columns are kept up to date by sort_records_soa.
+    Returns the headers and a (rows, 11) array: integer DIP followed by the 10 volumes.
     """
-    ref_dips = [rec['DIP'] for rec in records]
-    ref_kgs = [rec['Milk (KG)'] for rec in records]
-    if not ref_dips or not ref_kgs:
-        return ['DIP', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9'], []
-    
+    sorted_dips, vals = table_inputs(soa, mode)
+    return generate_dip_table(sorted_dips, vals, dip_start, dip_end)
+
+def generate_dip_table(sorted_dips, vals, dip_start=None, dip_end=None):
+    """Builds the DIP table from the sorted reference DIPs and their volumes (see generate_dip_table_from_records)."""
+    if len(sorted_dips) == 0:
+        return ['DIP', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9'], np.empty((0, 11))
+
+    curve = build_dip_curve(sorted_dips, vals)
+
+    # The sorted reference DIPs already hold the range bounds; no extra min/max scans
     if dip_start is None:
-        dip_start = int(min(ref_dips))
+        dip_start = int(curve.sorted_dips[0])
     if dip_end is None:
-        dip_end = max(ref_dips)
-    
-    # Build the correct value map for the selected mode
-    if mode == 'kg':
-        value_map = {d: kg for d, kg in zip(ref_dips, ref_kgs)}
-    else:
-        # Strict Conversion applied here
-        value_map = {d: convert_kg_to_litres(kg) for d, kg in zip(ref_dips, ref_kgs)}
-        
-    sorted_dips = sorted(value_map.keys())
-    output_data = []
+        dip_end = curve.sorted_dips[-1]
 
-    # Generate table row by row (integer DIPs)
+    # Generate table for integer DIP rows x 10 tenths in one pass
     start_int = int(dip_start)
     end_int = int(dip_end)
-    
-    for current_int_dip in range(start_int, end_int + 1):
-        row = [current_int_dip]
-        for tenths in range(10):
-            actual_dip = current_int_dip + (tenths / 10.0)
-            vol = get_volume_at_dip(actual_dip, sorted_dips, value_map)
-            row.append(round(vol, 2))
-        output_data.append(row)
+    int_dips = np.arange(start_int, end_int + 1)
+    slopes, avg_slope = curve.slope_ctx
+    if len(slopes) and np.allclose(slopes, slopes[0], rtol=1e-12, atol=0):
+        # Collinear reference points: every interval and the clamped smart slope
+        # share one step, so the whole table is a single broadcasted multiply-add
+        dips, vals = curve.sorted_dips, curve.vals
+        slope = (vals[1] - vals[0]) / (dips[1] - dips[0])
+        targets = int_dips[:, None] + np.arange(10) / 10.0
+        vols = vals[0] + (targets - dips[0]) * slope
+    else:
+        with _kernel_lock():
+            vols = _fill_table(curve.sorted_dips, curve.vals, start_int, end_int, slopes, avg_slope)
+    output_data = np.column_stack([int_dips, np.round(vols, 2)])
 
     headers = ['DIP', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
     return headers, output_data
 
 # --- Export Logic ---
 
-def generate_csv(records, mode='kg'):
-    headers, table = generate_dip_table_from_records(
-        st.session_state['records'],
-        dip_start=None,
-        dip_end=None,
-        mode=mode
+@st.cache_data(max_entries=16)
+def _cached_table(sorted_dips, vals):
+    # Shared by all download buttons so a rerun builds each table only once. Keyed on
+    # the table inputs alone (vals is already the KG or litre column), not the whole
+    # mirror, so record order, repeated DIPs and DIP(MM) don't cause misses.
+    return generate_dip_table(sorted_dips, vals)
+
+def generate_csv(soa, mode='kg'):
+    headers, table = _cached_table(*table_inputs(soa, mode))
+    buf = io.BytesIO()
+    buf.write((','.join(headers) + '\n').encode('utf-8'))
+    # Every value is a plain number, so no csv quoting is needed: write the whole array at once
+    np.savetxt(buf, table, fmt=['%d'] + ['%.2f'] * (len(headers) - 1), delimiter=',')
+    return buf.getvalue()
+
+@st.cache_data(max_entries=8)
+def _cached_pdf(sorted_dips, vals):
+    headers, table = _cached_table(sorted_dips, vals)
+    # One platypus Table for the whole grid; FPDF needed a cell() call (with its
+    # own font/page-break bookkeeping) per value plus a latin1 copy of the document.
+    page_width, _ = A4
+    margin = 10 * mm
+    col_width = page_width / (len(headers) + 1)
+    row_height = 10 * 1.5
+    rows = [[int(row[0])] + row[1:] for row in table.tolist()]
+    grid = Table(
+        [headers] + rows,
+        colWidths=[col_width] * len(headers),
+        rowHeights=row_height,
+        hAlign='LEFT'
     )
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(headers)
-    for row in table:
-        writer.writerow(row)
-    return output.getvalue().encode('utf-8')
-
-def generate_pdf(records, mode='kg'):
-    headers, table = generate_dip_table_from_records(
-        st.session_state['records'],
-        dip_start=None,
-        dip_end=None,
-        mode=mode
+    grid.setStyle(TableStyle([
+        ('FONT', (0, 0), (-1, -1), 'Helvetica', 10),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+        # Header with border and fill
+        ('BACKGROUND', (0, 0), (-1, 0), colors.Color(220 / 255, 220 / 255, 220 / 255)),
+    ]))
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buf, pagesize=A4,
+        leftMargin=margin, rightMargin=margin, topMargin=margin, bottomMargin=margin
     )
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=10)
-    # Calculate column width for table
-    col_width = pdf.w / (len(headers) + 1)
-    row_height = pdf.font_size * 1.5
-    # Header with border and fill
-    pdf.set_fill_color(220, 220, 220)
-    for header in headers:
-        pdf.cell(col_width, row_height, str(header), border=1, align='C', fill=True)
-    pdf.ln(row_height)
-    # Table rows with border
-    for row in table:
-        for item in row:
-            pdf.cell(col_width, row_height, str(item), border=1, align='C')
-        pdf.ln(row_height)
-    return pdf.output(dest='S').encode('latin1')
-
-def generate_raw_pdf(records):
+    doc.build([grid])
+    return buf.getvalue()
+
+def generate_pdf(soa, mode='kg'):
+    return _cached_pdf(*table_inputs(soa, mode))
+
+def generate_raw_pdf(soa):
     # Always generates in KG mode for "Raw"
-    return generate_pdf(records, mode='kg') # Reusing generate_pdf logic for simplicity if layout checks out
+    return generate_pdf(soa, mode='kg') # Served from the cached KG PDF bytes
 
 if st.session_state['records']:
     col1, col2, col3, col4, col5, col6 = st.columns(6)
     with col1:
         st.download_button(
             label="Download KG CSV",
-            data=generate_csv(st.session_state['records'], 'kg'),
+            data=partial(generate_csv, st.session_state['_records_soa'], 'kg'),
             file_name="output_kg.csv",
             mime="text/csv"
         )
     with col2:
         st.download_button(
             label="Download Litre CSV",
-            data=generate_csv(st.session_state['records'], 'litre'),
+            data=partial(generate_csv, st.session_state['_records_soa'], 'litre'),
             file_name="output_litre.csv",
             mime="text/csv"
         )
     with col3:
         st.download_button(
             label="Download KG PDF",
-            data=generate_pdf(st.session_state['records'], 'kg'),
+            data=generate_pdf(st.session_state['_records_soa'], 'kg'),
             file_name="output_kg.pdf",
             mime="application/pdf"
         )
     with col4:
         st.download_button(
             label="Download Litre PDF",
-            data=generate_pdf(st.session_state['records'], 'litre'),
+            data=generate_pdf(st.session_state['_records_soa'], 'litre'),
             file_name="output_litre.pdf",
             mime="application/pdf"
         )
     with col5:
         st.download_button(
             label="Download Raw PDF",
-            # Assuming generate_raw_pdf was intended to match generate_pdf structure but explicitly named
-            data=generate_pdf(st.session_state['records'], 'kg'), 
+            data=generate_raw_pdf(st.session_state['_records_soa']),
             file_name="output_raw.pdf",
             mime="application/pdf"
         )
     with col6:
         if st.button("Clear Records"):
             st.session_state['records'] = []
+            st.session_state['_records_soa'] = records_to_soa([])
             st.rerun() # Updated from experimental_rerun